@@ -1,4 +1,5 @@
-import json
+import ijson
+import orjson
 import re
 import os
 import functions_framework
@@ -7,22 +8,92 @@ from vertexai.generative_models import GenerativeModel
 from google.cloud import vision
 from google.cloud import firestore
 from google.cloud import storage
+import redis
 import requests
+import gzip
 import hashlib
 import secrets
+import itertools
+import collections
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
 
 # --- CONFIGURATION ---
 PROJECT_ID = os.environ.get("GCP_PROJECT_ID", "your-project-id")
 LOCATION = os.environ.get("GCP_LOCATION", "us-central1")
+REDIS_HOST = os.environ.get("REDIS_HOST")
+REDIS_PORT = int(os.environ.get("REDIS_PORT", 6379))
+# Keep an unreachable Redis (e.g. missing VPC connector) from stalling each invocation
+REDIS_TIMEOUT_SECONDS = 1.0
 
 # --- INITIALIZE CLIENTS ---
 vertexai.init(project=PROJECT_ID, location=LOCATION)
 vision_client = vision.ImageAnnotatorClient()
-firestore_client = firestore.Client(database="consent-management-db")
+# Small pool of Firestore clients (one gRPC channel each) shared round-robin by concurrent writes
+FIRESTORE_POOL_SIZE = 4
+firestore_clients = [firestore.Client(database="consent-management-db") for _ in range(FIRESTORE_POOL_SIZE)]
+_firestore_counter = itertools.count()
 storage_client = storage.Client()
+# Optional: the query service's Redis, so its cached patient document lists can be invalidated
+redis_client = redis.Redis(
+    host=REDIS_HOST,
+    port=REDIS_PORT,
+    socket_connect_timeout=REDIS_TIMEOUT_SECONDS,
+    socket_timeout=REDIS_TIMEOUT_SECONDS
+) if REDIS_HOST else None
 model = GenerativeModel("gemini-2.0-flash-exp") # Using Gemini 2.0 Flash for better OCR extraction
 
+# Max number of OCR output shards downloaded from GCS in parallel
+MAX_DOWNLOAD_WORKERS = 16
+
+# Vision AI OCR operation timeout and polling interval, in seconds
+OCR_TIMEOUT = 420
+OCR_POLL_INTERVAL = 2
+
+# Optional batching of Gemini calls across concurrent invocations on the same instance.
+# Only useful when the function runs with concurrency > 1; disabled (0 ms) by default.
+GEMINI_BATCH_WINDOW = float(os.environ.get("GEMINI_BATCH_WINDOW_MS", "0")) / 1000
+GEMINI_BATCH_MAX_SIZE = int(os.environ.get("GEMINI_BATCH_MAX_SIZE", "8"))
+_gemini_queue = collections.deque()
+_gemini_queue_lock = threading.Lock()
+
+# Field definitions shared by the single-document and batched analysis prompts
+ANALYSIS_FIELDS = """
+The JSON object should have these exact keys: "summary", "entities", "consented_items", "declined_items", "patient_id".
+
+- "summary": A brief, one-paragraph summary of the document's purpose.
+- "entities": An object containing key entities like "patient_name", "patient_email", "date_of_birth", "doctor_name", "procedure", and "date". If a value is not found, use "N/A".
+- "consented_items": A list of strings, where each string is a specific item the patient consented to.
+- "declined_items": A list of strings, where each string is a specific item the patient declined.
+- "patient_id": Extract or generate a unique identifier for the patient (e.g., email, patient number, or combination of name and DOB). This is critical for patient-specific access.
+
+IMPORTANT: Extract patient identification information carefully as it will be used for authentication and authorization.
+"""
+
+# Vision AI names its output shards "output-<first page>-to-<last page>.json"
+_OCR_SHARD_PATTERN = re.compile(r"output-(\d+)-to-\d+\.json$")
+
+# Markdown code fence Gemini sometimes wraps its JSON output in
+_CODE_FENCE_PATTERN = re.compile(r"^```(?:json)?\s*|\s*```$")
+
+# Bucket handles reused across warm invocations
+_bucket_cache = {}
+
+
+def _get_firestore_client():
+    """Return the next Firestore client from the pool"""
+    return firestore_clients[next(_firestore_counter) % FIRESTORE_POOL_SIZE]
+
+
+def _get_bucket(bucket_name: str):
+    """Return a cached bucket handle (storage_client.bucket() makes no API call)"""
+    if bucket_name not in _bucket_cache:
+        _bucket_cache[bucket_name] = storage_client.bucket(bucket_name)
+    return _bucket_cache[bucket_name]
+
+
 @functions_framework.cloud_event
 def process_consent_pdf(cloud_event):
     """This function is triggered by a file upload to GCS."""
@@ -37,12 +108,24 @@ def process_consent_pdf(cloud_event):
 
     print(f"Processing file: {file_name} from bucket: {bucket_name}")
 
+    # Skip re-uploads of identical bytes that were already processed (avoids OCR + Gemini cost)
+    doc_id = file_name.replace(".pdf", "")
+    storage_bucket = _get_bucket(bucket_name)
+    source_md5 = data.get("md5Hash")
+    if source_md5 is None:
+        source_blob = storage_bucket.get_blob(file_name)
+        source_md5 = source_blob.md5_hash if source_blob else None
+    existing_consent = _get_existing_consent(doc_id)
+    if existing_consent and source_md5 and existing_consent.get("source_md5") == source_md5:
+        print(f"'{file_name}' is unchanged since it was last processed - nothing to do.")
+        return
+
     # 1. Run OCR on the PDF file in Cloud Storage using the Vision AI API
     gcs_source_uri = f"gs://{bucket_name}/{file_name}"
     gcs_destination_uri = f"gs://{bucket_name}/{file_name}-ocr-output/"
 
     mime_type = "application/pdf"
-    batch_size = 2
+    batch_size = 100  # Vision API maximum: one output shard per 100 pages
     feature = vision.Feature(type_=vision.Feature.Type.DOCUMENT_TEXT_DETECTION)
 
     gcs_source = vision.GcsSource(uri=gcs_source_uri)
@@ -57,91 +140,139 @@ def process_consent_pdf(cloud_event):
 
     operation = vision_client.async_batch_annotate_files(requests=[async_request])
     print("Waiting for the Vision AI OCR operation to complete...")
-    operation.result(timeout=420)
-    print("OCR operation finished.")
-
-    # 2. Read the OCR output text from the JSON files created by Vision AI
-    storage_bucket = storage_client.get_bucket(bucket_name)
-    blob_list = [
-        b for b in storage_bucket.list_blobs(prefix=f"{file_name}-ocr-output/")
-        if ".json" in b.name
-    ]
-    
-    full_text = ""
-    for blob in blob_list:
-        json_string = blob.download_as_string()
-        response = json.loads(json_string)
-        for page_response in response["responses"]:
-            full_text += page_response["fullTextAnnotation"]["text"]
+
+    # 2. Read the OCR output text from the JSON files created by Vision AI.
+    # Poll the operation instead of blocking on it, and start downloading each shard as soon as
+    # it appears so the download + parse overlaps the rest of the OCR run.
+    shard_futures = {}
+    deadline = time.monotonic() + OCR_TIMEOUT
+    with ThreadPoolExecutor(max_workers=MAX_DOWNLOAD_WORKERS) as executor:
+        while True:
+            ocr_done = operation.done()
+            for blob in storage_bucket.list_blobs(prefix=f"{file_name}-ocr-output/"):
+                if ".json" in blob.name and blob.name not in shard_futures:
+                    shard_futures[blob.name] = (blob, executor.submit(_read_ocr_page_texts, blob))
+            if ocr_done:
+                break
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Vision AI OCR did not finish within {OCR_TIMEOUT} seconds")
+            time.sleep(OCR_POLL_INTERVAL)
+        # Raises if the OCR operation itself failed
+        operation.result()
+        print("OCR operation finished.")
+
+        # Shards may be discovered out of order, so put them back in page order
+        ordered_shards = sorted(shard_futures.values(), key=lambda shard: _ocr_shard_first_page(shard[0].name))
+        blob_list = [blob for blob, _ in ordered_shards]
+        shard_page_texts = [future.result() for _, future in ordered_shards]
+
+    text_chunks = []
+    for page_texts in shard_page_texts:
+        text_chunks.extend(page_texts)
+    full_text = "".join(text_chunks)
     
     print("Successfully extracted text from OCR output.")
 
     # 3. Analyze the extracted text with the Gemini AI model
-    prompt = f"""
-    Analyze the following medical consent form text and respond ONLY with a valid JSON object.
-    The JSON object should have these exact keys: "summary", "entities", "consented_items", "declined_items", "patient_id".
-    
-    - "summary": A brief, one-paragraph summary of the document's purpose.
-    - "entities": An object containing key entities like "patient_name", "patient_email", "date_of_birth", "doctor_name", "procedure", and "date". If a value is not found, use "N/A".
-    - "consented_items": A list of strings, where each string is a specific item the patient consented to.
-    - "declined_items": A list of strings, where each string is a specific item the patient declined.
-    - "patient_id": Extract or generate a unique identifier for the patient (e.g., email, patient number, or combination of name and DOB). This is critical for patient-specific access.
-    
-    IMPORTANT: Extract patient identification information carefully as it will be used for authentication and authorization.
-    
-    TEXT:
-    {full_text}
-    """
-    
-    try:
-        response = model.generate_content(prompt)
-        cleaned_response = response.text.strip().replace("```json", "").replace("```", "")
-        print("Gemini analysis complete.")
-    except Exception as e:
-        print(f"Error with Gemini model: {str(e)}")
-        # Fallback: create a basic analysis
-        cleaned_response = json.dumps({
-            "summary": "Consent form processed - AI analysis failed",
-            "entities": {
-                "patient_name": "N/A",
-                "patient_email": "N/A",
-                "date_of_birth": "N/A",
-                "doctor_name": "N/A", 
-                "procedure": "N/A",
-                "date": "N/A"
-            },
-            "consented_items": ["Analysis pending"],
-            "declined_items": [],
-            "patient_id": "unknown"
-        })
-        print("Using fallback analysis due to model error.")
+    # Identical OCR text yields the same analysis, so reuse a cached Gemini result when present
+    cache_key = hashlib.sha256(full_text.encode()).hexdigest()
+    cleaned_response = _get_cached_analysis(cache_key)
+    if cleaned_response:
+        print("Using cached Gemini analysis.")
+    else:
+        try:
+            cleaned_response = _generate_analysis(full_text)
+            print("Gemini analysis complete.")
+            _cache_analysis(cache_key, cleaned_response)
+        except Exception as e:
+            print(f"Error with Gemini model: {str(e)}")
+            # Fallback: create a basic analysis
+            cleaned_response = orjson.dumps({
+                "summary": "Consent form processed - AI analysis failed",
+                "entities": {
+                    "patient_name": "N/A",
+                    "patient_email": "N/A",
+                    "date_of_birth": "N/A",
+                    "doctor_name": "N/A", 
+                    "procedure": "N/A",
+                    "date": "N/A"
+                },
+                "consented_items": ["Analysis pending"],
+                "declined_items": [],
+                "patient_id": "unknown"
+            }).decode()
+            print("Using fallback analysis due to model error.")
+            # Don't record the source hash, so re-uploading the same file retries the analysis
+            source_md5 = None
+
+    # A previous run for this document already synced the account if the patient is unchanged
+    already_processed = (
+        existing_consent is not None
+        and _extract_patient_email(existing_consent.get("ai_analysis_json")) == _extract_patient_email(cleaned_response)
+    )
 
-    # 4. Save the analysis to your Firestore database
+    # 4-7. The remaining steps are independent network calls, so run them concurrently
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        futures = [
+            executor.submit(_save_analysis, storage_bucket, doc_id, file_name, source_md5, cleaned_response, full_text),
+            executor.submit(_delete_ocr_output, storage_bucket, blob_list),
+        ]
+        if already_processed:
+            print(f"'{doc_id}' was processed before for the same patient - skipping account sync.")
+        else:
+            futures.append(executor.submit(_sync_patient_account, cleaned_response))
+    # Surface any failure (e.g. the Firestore save) once every step has finished
+    for future in futures:
+        future.result()
+
+
+def _save_analysis(storage_bucket, doc_id: str, file_name: str, source_md5, cleaned_response: str, full_text: str) -> None:
+    """Steps 4 and 5: save the analysis and enhanced query data to Firestore"""
+    # Build enhanced data for the query system (failures here don't block saving the analysis)
+    entity_payload = _build_enhanced_analysis(doc_id, cleaned_response, full_text)
+
+    # Save the analysis and enhanced data in a single batched commit
     try:
-        doc_id = file_name.replace(".pdf", "")
+        # Raw OCR text can approach Firestore's 1 MiB document limit, so keep it compressed in GCS
+        full_text_blob = storage_bucket.blob(f"full-text/{doc_id}.txt.gz")
+        full_text_blob.upload_from_string(gzip.compress(full_text.encode()), content_type="application/gzip")
+
+        firestore_client = _get_firestore_client()
+        batch = firestore_client.batch()
         doc_ref = firestore_client.collection("consents").document(doc_id)
-        doc_ref.set({
+        batch.set(doc_ref, {
             "filename": file_name,
+            "source_md5": source_md5,
             "ai_analysis_json": cleaned_response,
-            "full_text": full_text,
+            "full_text_uri": f"gs://{storage_bucket.name}/{full_text_blob.name}",
             "processed_timestamp": firestore.SERVER_TIMESTAMP
         })
+        if entity_payload is not None:
+            entity_doc_ref = firestore_client.collection("entity_index").document(doc_id)
+            batch.set(entity_doc_ref, entity_payload)
+        batch.commit()
         print(f"Successfully saved analysis for '{doc_id}' to Firestore.")
+        if entity_payload is not None:
+            _invalidate_patient_docs_cache(entity_payload["patient_email"])
     except Exception as e:
         print(f"Error saving to Firestore: {str(e)}")
         raise e
 
-    # 5. Store enhanced data in Firestore for query system
+
+def _invalidate_patient_docs_cache(patient_email: str) -> None:
+    """Drop the query service's cached document list for this patient so the new form shows up"""
+    if redis_client is None or patient_email == "N/A":
+        return
     try:
-        _store_enhanced_analysis(doc_id, cleaned_response, full_text)
-        print(f"Successfully stored enhanced analysis for '{doc_id}' in Firestore.")
+        redis_client.delete(f"pd:{patient_email}")
     except Exception as e:
-        print(f"Error storing enhanced analysis: {str(e)}")
-        # Don't fail the whole process if enhanced storage fails
+        print(f"Cache invalidation error: {e}")
+
 
-    # 6. Create or update patient account automatically
+def _sync_patient_account(cleaned_response: str) -> None:
+    """Step 6: create or update the patient account automatically"""
     try:
-        analysis = json.loads(cleaned_response)
+        analysis = orjson.loads(cleaned_response)
         entities = analysis.get("entities", {})
         patient_email = entities.get("patient_email", "").lower()
         patient_name = entities.get("patient_name", "N/A")
@@ -155,52 +286,187 @@ def process_consent_pdf(cloud_event):
         print(f"Error creating patient account: {str(e)}")
         # Don't fail the whole process if account creation fails
 
-    # 7. Clean up the OCR output files from the bucket
-    for blob in blob_list:
-        blob.delete()
+
+def _delete_ocr_output(storage_bucket, blob_list: list) -> None:
+    """Step 7: clean up the OCR output files from the bucket"""
+    # Send all deletes in a single batch request instead of one round-trip per shard
+    if blob_list:
+        with storage_client.batch():
+            storage_bucket.delete_blobs(blob_list)
     print("Cleaned up temporary OCR output files.")
 
 
-def _store_enhanced_analysis(document_id: str, analysis_json: str, full_text: str) -> None:
-    """Store enhanced analysis in Firestore for better querying with patient isolation"""
+def _get_existing_consent(doc_id: str):
+    """Return the previously saved consents document for this doc_id, if any"""
+    try:
+        existing = _get_firestore_client().collection("consents").document(doc_id).get()
+        if existing.exists:
+            return existing.to_dict()
+    except Exception as e:
+        print(f"Duplicate check error: {e}")
+    return None
+
+
+def _extract_patient_email(analysis_json) -> str:
+    """Return the lowercased patient email from an analysis JSON string, or "" if there is none"""
+    try:
+        patient_email = orjson.loads(analysis_json).get("entities", {}).get("patient_email", "").lower()
+    except Exception:
+        return ""
+    return "" if patient_email == "n/a" else patient_email
+
+
+def _ocr_shard_first_page(blob_name: str) -> int:
+    """Return the first page number covered by an OCR output shard (0 if the name is unrecognised)"""
+    match = _OCR_SHARD_PATTERN.search(blob_name)
+    return int(match.group(1)) if match else 0
+
+
+def _read_ocr_page_texts(blob) -> list:
+    """Stream a Vision AI OCR output shard and return only the per-page text"""
+    # Parse incrementally so the multi-MB annotation JSON is never held in memory
+    with blob.open("rb") as f:
+        return list(ijson.items(f, "responses.item.fullTextAnnotation.text"))
+
+
+def _generate_analysis(full_text: str) -> str:
+    """Run the Gemini analysis for one document, batching with concurrent invocations when enabled"""
+    if GEMINI_BATCH_WINDOW <= 0:
+        return _run_gemini_analysis([full_text])[0]
+
+    future = Future()
+    with _gemini_queue_lock:
+        _gemini_queue.append((full_text, future))
+        queue_size = len(_gemini_queue)
+    if queue_size >= GEMINI_BATCH_MAX_SIZE:
+        _flush_gemini_queue()
+    elif queue_size == 1:
+        # First document of a new batch: flush whatever has accumulated once the window closes
+        threading.Timer(GEMINI_BATCH_WINDOW, _flush_gemini_queue).start()
+    return future.result()
+
+
+def _flush_gemini_queue() -> None:
+    """Send all queued documents to Gemini in one request and resolve their futures"""
+    with _gemini_queue_lock:
+        pending = [_gemini_queue.popleft() for _ in range(min(len(_gemini_queue), GEMINI_BATCH_MAX_SIZE))]
+    if not pending:
+        return
+    try:
+        analyses = _run_gemini_analysis([text for text, _ in pending])
+        for (_, future), analysis in zip(pending, analyses):
+            future.set_result(analysis)
+    except Exception as e:
+        for _, future in pending:
+            future.set_exception(e)
+
+
+def _run_gemini_analysis(texts: list) -> list:
+    """Analyze one or more consent form texts in a single Gemini request, returning one JSON string per text"""
+    if len(texts) == 1:
+        prompt = f"""Analyze the following medical consent form text and respond ONLY with a valid JSON object.
+{ANALYSIS_FIELDS}
+TEXT:
+{texts[0]}
+"""
+        response = model.generate_content(prompt)
+        return [_CODE_FENCE_PATTERN.sub("", response.text.strip())]
+
+    documents = "".join(f"\n--- DOCUMENT {i} ---\n{text}\n" for i, text in enumerate(texts, 1))
+    prompt = f"""Analyze each of the following {len(texts)} medical consent form texts and respond ONLY with a valid JSON array
+containing one JSON object per document, in the same order as the documents.
+{ANALYSIS_FIELDS}
+{documents}
+"""
+    response = model.generate_content(prompt)
+    analyses = orjson.loads(_CODE_FENCE_PATTERN.sub("", response.text.strip()))
+    if not isinstance(analyses, list) or len(analyses) != len(texts):
+        raise ValueError(f"Expected {len(texts)} analyses from Gemini, got {len(analyses) if isinstance(analyses, list) else 'non-list'}")
+    print(f"Gemini batch analysis complete for {len(texts)} documents.")
+    return [orjson.dumps(analysis).decode() for analysis in analyses]
+
+
+def _get_cached_analysis(cache_key: str):
+    """Return a previously cached Gemini analysis for identical OCR text, if any"""
+    try:
+        cached_doc = _get_firestore_client().collection("gemini_cache").document(cache_key).get()
+        if cached_doc.exists:
+            return cached_doc.get("analysis_json")
+    except Exception as e:
+        print(f"Gemini cache lookup error: {e}")
+    return None
+
+
+def _cache_analysis(cache_key: str, analysis_json: str) -> None:
+    """Cache a Gemini analysis keyed by the hash of its OCR text"""
+    try:
+        # Only cache parseable output so a malformed response is not replayed forever
+        orjson.loads(analysis_json)
+        _get_firestore_client().collection("gemini_cache").document(cache_key).set({
+            "analysis_json": analysis_json,
+            "cached_timestamp": firestore.SERVER_TIMESTAMP
+        })
+    except Exception as e:
+        print(f"Gemini cache write error: {e}")
+
+
+def _build_enhanced_analysis(document_id: str, analysis_json: str, full_text: str):
+    """Build the entity_index document used for querying with patient isolation"""
     try:
-        analysis = json.loads(analysis_json)
+        analysis = orjson.loads(analysis_json)
         entities = analysis.get("entities", {})
         
         # Create searchable entity data
         entity_data = {}
-        search_terms = []
+        search_terms = set()
         
         for entity_type, entity_value in entities.items():
             if entity_value and entity_value != "N/A":
                 entity_data[entity_type] = entity_value
-                # Create searchable terms for better querying
-                search_terms.append(f"{entity_type}:{entity_value}")
-                search_terms.append(entity_value.lower())
+                # Create searchable terms for better querying (deduplicated to keep index writes small)
+                search_terms.add(f"{entity_type}:{entity_value}")
+                search_terms.add(entity_value.lower())
+        
+        # Individual name tokens let the query service resolve "john" or "smith" with one lookup
+        patient_name = entities.get("patient_name", "N/A")
+        if patient_name and patient_name != "N/A":
+            search_terms.update(patient_name.lower().split())
         
         # Extract patient identifier for secure access control
         patient_id = analysis.get("patient_id", "unknown")
         patient_email = entities.get("patient_email", "N/A")
         
-        # Store in a separate collection for entity-based queries
-        entity_doc_ref = firestore_client.collection("entity_index").document(document_id)
-        entity_doc_ref.set({
+        print(f"Enhanced entity data built for {document_id} (patient: {patient_id})")
+        
+        # Stored in a separate collection for entity-based queries
+        return {
             "document_id": document_id,
             "entities": entity_data,
-            "search_terms": search_terms,
-            "patient_name": entities.get("patient_name", "N/A"),
+            "search_terms": sorted(search_terms),
+            "patient_name": patient_name,
             "patient_id": patient_id,
             "patient_email": patient_email.lower() if patient_email != "N/A" else "N/A",
             "consented_items": analysis.get("consented_items", []),
             "declined_items": analysis.get("declined_items", []),
             "summary": analysis.get("summary", ""),
             "processed_timestamp": firestore.SERVER_TIMESTAMP
-        })
-        
-        print(f"Enhanced entity data stored for {document_id} (patient: {patient_id})")
+        }
         
     except Exception as e:
-        print(f"Enhanced storage error: {e}")
+        print(f"Enhanced analysis error: {e}")
+        return None
+
+
+def _hash_password(password: str) -> tuple:
+    """Hash a password with scrypt and a random salt, returning (hash_hex, salt_hex)"""
+    salt = secrets.token_bytes(16)
+    password_hash = hashlib.scrypt(password.encode(), salt=salt, n=2**14, r=8, p=1)
+    return password_hash.hex(), salt.hex()
+
+
+def _patient_doc_id(patient_email: str) -> str:
+    """Deterministic patients document ID derived from the (lowercased) email"""
+    return hashlib.sha256(patient_email.encode()).hexdigest()
 
 
 def _create_patient_account(patient_email: str, patient_name: str) -> None:
@@ -210,19 +476,22 @@ def _create_patient_account(patient_email: str, patient_name: str) -> None:
         # Format: FirstName + "123!" (simple default - in production, send email with password)
         default_password = f"{patient_name.split()[0].lower() if patient_name != 'N/A' else 'patient'}123!"
         
-        # Hash the password
-        password_hash = hashlib.sha256(default_password.encode()).hexdigest()
+        # Hash the password with a salted KDF
+        password_hash, password_salt = _hash_password(default_password)
         
-        # Check if patient already exists
-        patients_ref = firestore_client.collection("patients")
-        existing_patients = patients_ref.where("email", "==", patient_email).limit(1).stream()
+        # Check if patient already exists (keyed by email hash, so no query is needed)
+        patients_ref = _get_firestore_client().collection("patients")
+        patient_ref = patients_ref.document(_patient_doc_id(patient_email))
+        existing_patient = patient_ref.get()
         
-        existing_patient = None
-        for doc in existing_patients:
-            existing_patient = doc
-            break
+        if not existing_patient.exists:
+            # Accounts created before email-hash document IDs live under a random ID; update
+            # that record in place rather than creating a second one with the default password
+            for legacy_patient in patients_ref.where("email", "==", patient_email).limit(1).stream():
+                patient_ref = legacy_patient.reference
+                existing_patient = legacy_patient
         
-        if existing_patient:
+        if existing_patient.exists:
             # Update existing patient (but keep password if already set by user)
             existing_data = existing_patient.to_dict()
             update_data = {
@@ -233,16 +502,17 @@ def _create_patient_account(patient_email: str, patient_name: str) -> None:
             # Only update password if it hasn't been changed by user (check if it's still default format)
             if not existing_data.get("password_hash"):
                 update_data["password_hash"] = password_hash
+                update_data["password_salt"] = password_salt
                 update_data["default_password"] = default_password
             
-            existing_patient.reference.update(update_data)
+            patient_ref.set(update_data, merge=True)
             print(f"Updated existing patient account for {patient_email}")
         else:
             # Create new patient account
-            patient_id = secrets.token_urlsafe(16)
-            patients_ref.document(patient_id).set({
+            patient_ref.set({
                 "email": patient_email,
                 "password_hash": password_hash,
+                "password_salt": password_salt,
                 "patient_name": patient_name,
                 "default_password": default_password,  # Store for reference (remove in production)
                 "created_at": firestore.SERVER_TIMESTAMP,
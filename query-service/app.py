@@ -1,66 +1,222 @@
 import json
 import os
+import re
 from flask import Flask, request, jsonify
 from flask_cors import CORS
+from flask_compress import Compress
+from werkzeug.exceptions import RequestEntityTooLarge
+import redis
+import bcrypt
+from cachetools import TTLCache
 from google.cloud import firestore
 from google.cloud import storage
 import vertexai
 from vertexai.generative_models import GenerativeModel
+from vertexai.language_models import TextEmbeddingModel
 import logging
+import math
 import uuid
 import hashlib
+import hmac
 import secrets
-from datetime import datetime, timedelta
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
 
 # Configuration
 PROJECT_ID = os.environ.get("GCP_PROJECT_ID", "your-project-id")
 LOCATION = os.environ.get("GCP_LOCATION", "us-central1")
 
-# Initialize clients (lazy loading to save memory)
-firestore_client = None
-storage_client = None
-model = None
-
-def get_firestore_client():
-    global firestore_client
-    if firestore_client is None:
-        firestore_client = firestore.Client(database="consent-management-db")
-    return firestore_client
-
-def get_storage_client():
-    global storage_client
-    if storage_client is None:
-        storage_client = storage.Client()
-    return storage_client
-
-def get_model():
-    global model
-    if model is None:
-        vertexai.init(project=PROJECT_ID, location=LOCATION)
-        model = GenerativeModel("gemini-2.0-flash-exp")  # Better model for OCR understanding
-    return model
-
-# Session store (in production, use Redis or similar)
-active_sessions = {}
+# Initialize clients once at import; the SDKs pool their connections internally.
+# Set INITIALIZE_CLIENTS=0 to import the module without GCP/Redis access (e.g. in tests).
+FIRESTORE = None
+STORAGE = None
+MODEL = None
+EMBEDDING_MODEL = None
+REDIS = None
+
+if os.environ.get('INITIALIZE_CLIENTS', '1') == '1':
+    FIRESTORE = firestore.Client(database="consent-management-db")
+    STORAGE = storage.Client()
+    vertexai.init(project=PROJECT_ID, location=LOCATION)
+    MODEL = GenerativeModel("gemini-2.0-flash-exp")  # Better model for OCR understanding
+    EMBEDDING_MODEL = TextEmbeddingModel.from_pretrained("text-embedding-004")
+    # Redis is optional: without REDIS_HOST, sessions fall back to an in-process store and caching is off
+    if os.environ.get("REDIS_HOST"):
+        # Short timeouts so an unreachable Redis fails fast instead of tying up request threads
+        REDIS = redis.Redis(connection_pool=redis.ConnectionPool(
+            host=os.environ["REDIS_HOST"],
+            port=int(os.environ.get("REDIS_PORT", 6379)),
+            socket_connect_timeout=1.0,
+            socket_timeout=1.0
+        ))
+
+# Query parsing patterns (compiled once at import)
+PATIENT_PATTERN = re.compile(r'patient\s+(\w+)|\b(\w+)\b')
+KEY_ENTITY_PATTERNS = [
+    re.compile(r'patient\s+(\w+)'),
+    re.compile(r'(\w+)\s+declined'),
+    re.compile(r'(\w+)\s+consented'),
+    re.compile(r'what\s+did\s+(\w+)'),
+    re.compile(r'(\w+)\s+patient')
+]
+QUERY_KEYWORDS = ('consent', 'decline', 'agree', 'procedure', 'research')
+
+# bcrypt cost factor (~100ms per hash); only paid at register/login, never per request
+BCRYPT_ROUNDS = 12
+
+# Session store: Redis when configured (shared by all workers/instances), otherwise a bounded
+# in-process TTLCache. Both expire sessions on their own, so no manual expiry check is needed.
+SESSION_TTL_SECONDS = 8 * 60 * 60
+local_sessions = TTLCache(maxsize=50000, ttl=SESSION_TTL_SECONDS)
+local_sessions_lock = threading.Lock()
+
+def session_key(session_token):
+    """Redis key holding a session's data"""
+    return f"sess:{session_token}"
+
+def save_session(session_token, session_data):
+    """Store a new session for SESSION_TTL_SECONDS"""
+    if REDIS is not None:
+        REDIS.setex(session_key(session_token), SESSION_TTL_SECONDS, json.dumps(session_data))
+    else:
+        with local_sessions_lock:
+            local_sessions[session_token] = session_data
+
+def load_session(session_token):
+    """Return the session data for a token, or None if it is unknown or expired"""
+    if REDIS is not None:
+        session_json = REDIS.get(session_key(session_token))
+        return json.loads(session_json) if session_json else None
+    with local_sessions_lock:
+        return local_sessions.get(session_token)
+
+def delete_session(session_token):
+    """Remove a session (logout)"""
+    if REDIS is not None:
+        REDIS.delete(session_key(session_token))
+    else:
+        with local_sessions_lock:
+            local_sessions.pop(session_token, None)
+
+# Recently looked-up patient records, so repeat logins skip Firestore
+PATIENT_CACHE_TTL_SECONDS = 300
+patient_cache = TTLCache(maxsize=1024, ttl=PATIENT_CACHE_TTL_SECONDS)
+patient_cache_lock = threading.Lock()
+
+def patient_doc_id(email):
+    """Deterministic patients document ID (same scheme as the ingestion function)"""
+    return hashlib.sha256(email.encode()).hexdigest()
+
+def get_patient_record(email):
+    """Look up a patient by email via a keyed read, falling back to the email query for older accounts"""
+    with patient_cache_lock:
+        cached = patient_cache.get(email)
+    if cached is not None:
+        return cached
+    
+    patients_ref = FIRESTORE.collection("patients")
+    snapshot = patients_ref.document(patient_doc_id(email)).get()
+    patient_doc = snapshot.to_dict() if snapshot.exists else None
+    
+    if patient_doc is None:
+        # Accounts created before email-hash document IDs were introduced (ingestion updates
+        # these in place, so an email never has both a keyed and a legacy record)
+        for doc in patients_ref.where("email", "==", email).limit(1).stream():
+            patient_doc = doc.to_dict()
+    
+    # Only cache hits, so an account created by ingestion is picked up immediately
+    if patient_doc is not None:
+        with patient_cache_lock:
+            patient_cache[email] = patient_doc
+    return patient_doc
+
+# Patient document lists cached in Redis (also invalidated by the ingestion function on new uploads)
+PATIENT_DOCS_CACHE_TTL_SECONDS = 300
+
+# Gemini answers cached per (patient, documents fingerprint, normalized question)
+ANSWER_CACHE_TTL_SECONDS = 3600
+
+# Answers are patient-specific: let only the patient's own browser reuse them briefly
+QUERY_CACHE_CONTROL = 'private, max-age=60'
+
+def patient_docs_cache_key(patient_email):
+    """Redis key holding a patient's cached entity_index documents"""
+    return f"pd:{patient_email}"
+
+def get_cached_json(key):
+    """Return a JSON value cached in Redis, or None on a miss or Redis error"""
+    if REDIS is None:
+        return None
+    try:
+        cached = REDIS.get(key)
+        return json.loads(cached) if cached else None
+    except Exception as e:
+        logging.warning(f"Cache read error for {key}: {str(e)}")
+        return None
+
+def set_cached_json(key, ttl_seconds, value):
+    """Cache a JSON-serializable value in Redis; cache failures never fail the request"""
+    if REDIS is None:
+        return
+    try:
+        REDIS.setex(key, ttl_seconds, json.dumps(value))
+    except Exception as e:
+        logging.warning(f"Cache write error for {key}: {str(e)}")
 
 def hash_password(password):
-    """Hash password using SHA-256"""
+    """Hash password using bcrypt with a per-user salt"""
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode()
+
+def legacy_hash_password(password):
+    """Unsalted SHA-256 hash used by accounts created before bcrypt/scrypt"""
     return hashlib.sha256(password.encode()).hexdigest()
 
+def check_password(password, patient_doc):
+    """Check a password against a stored bcrypt, scrypt (auto-created accounts) or legacy SHA-256 hash"""
+    stored_hash = patient_doc.get('password_hash', '')
+    salt = patient_doc.get('password_salt')
+    if stored_hash.startswith('$2'):
+        return bcrypt.checkpw(password.encode(), stored_hash.encode())
+    if salt:
+        candidate = hashlib.scrypt(password.encode(), salt=bytes.fromhex(salt), n=2**14, r=8, p=1).hex()
+    else:
+        candidate = legacy_hash_password(password)
+    return hmac.compare_digest(candidate, stored_hash)
+
+def is_legacy_hash(patient_doc):
+    """True for unsalted SHA-256 hashes, which are upgraded to bcrypt on the next login"""
+    return not patient_doc.get('password_hash', '').startswith('$2') and not patient_doc.get('password_salt')
+
+def upgrade_password_hash(email, password):
+    """Replace a legacy SHA-256 hash with bcrypt after a successful login"""
+    patients_ref = FIRESTORE.collection("patients")
+    patient_ref = patients_ref.document(patient_doc_id(email))
+    if not patient_ref.get().exists:
+        # Legacy hashes normally live on accounts created before email-hash document IDs
+        for doc in patients_ref.where("email", "==", email).limit(1).stream():
+            patient_ref = doc.reference
+    patient_ref.update({"password_hash": hash_password(password)})
+    with patient_cache_lock:
+        patient_cache.pop(email, None)
+
 def verify_session(f):
     """Decorator to verify patient session"""
     @wraps(f)
     def decorated_function(*args, **kwargs):
         session_token = request.headers.get('Authorization')
-        if not session_token or session_token not in active_sessions:
+        try:
+            session_data = load_session(session_token) if session_token else None
+        except redis.RedisError as e:
+            logging.error(f"Session store error: {str(e)}")
+            return jsonify({"error": "Session service unavailable. Please try again shortly."}), 503
+        if not session_data:
+            # Unknown and expired tokens look the same once the store has dropped the session
             return jsonify({"error": "Unauthorized. Please log in."}), 401
         
-        session_data = active_sessions[session_token]
-        if datetime.now() > session_data['expires']:
-            del active_sessions[session_token]
-            return jsonify({"error": "Session expired. Please log in again."}), 401
-        
         # Add patient email to request context
         request.patient_email = session_data['email']
         return f(*args, **kwargs)
@@ -69,7 +225,11 @@ def verify_session(f):
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
+app.config['COMPRESS_MIMETYPES'] = ['application/json']
+app.config['COMPRESS_MIN_SIZE'] = 512
+Compress(app)  # gzip/brotli JSON responses based on Accept-Encoding
 logging.basicConfig(level=logging.INFO)
+logging.getLogger('google').setLevel(logging.WARNING)  # Quiet chatty GCP SDK logs
 
 @app.route('/register', methods=['POST'])
 def register_patient():
@@ -85,16 +245,11 @@ def register_patient():
             return jsonify({"error": "Email and password are required"}), 400
         
         # Check if patient already exists
-        firestore_client = get_firestore_client()
-        patients_ref = firestore_client.collection("patients")
-        existing = patients_ref.where("email", "==", email).limit(1).stream()
-        
-        if list(existing):
+        if get_patient_record(email):
             return jsonify({"error": "Patient already registered"}), 409
         
-        # Create patient record
-        patient_id = str(uuid.uuid4())
-        patients_ref.document(patient_id).set({
+        # Create patient record (keyed by email hash, shared with the ingestion function)
+        FIRESTORE.collection("patients").document(patient_doc_id(email)).set({
             "email": email,
             "password_hash": hash_password(password),
             "patient_name": patient_name,
@@ -124,29 +279,29 @@ def login_patient():
             return jsonify({"error": "Email and password are required"}), 400
         
         # Find patient
-        firestore_client = get_firestore_client()
-        patients_ref = firestore_client.collection("patients")
-        patients = patients_ref.where("email", "==", email).limit(1).stream()
-        
-        patient_doc = None
-        for doc in patients:
-            patient_doc = doc.to_dict()
-            break
+        patient_doc = get_patient_record(email)
         
         if not patient_doc:
             return jsonify({"error": "Invalid email or password"}), 401
         
         # Verify password
-        if patient_doc.get('password_hash') != hash_password(password):
+        if not check_password(password, patient_doc):
             return jsonify({"error": "Invalid email or password"}), 401
         
+        if is_legacy_hash(patient_doc):
+            # A failed upgrade is retried on the next login, so it never blocks this one
+            try:
+                upgrade_password_hash(email, password)
+                logging.info(f"Upgraded legacy password hash for: {email}")
+            except Exception as e:
+                logging.warning(f"Password hash upgrade failed for {email}: {str(e)}")
+        
         # Create session
         session_token = secrets.token_urlsafe(32)
-        active_sessions[session_token] = {
+        save_session(session_token, {
             'email': email,
-            'patient_name': patient_doc.get('patient_name', 'N/A'),
-            'expires': datetime.now() + timedelta(hours=8)
-        }
+            'patient_name': patient_doc.get('patient_name', 'N/A')
+        })
         
         logging.info(f"Patient logged in: {email}")
         return jsonify({
@@ -165,8 +320,7 @@ def login_patient():
 def logout_patient():
     """Patient logout"""
     session_token = request.headers.get('Authorization')
-    if session_token in active_sessions:
-        del active_sessions[session_token]
+    delete_session(session_token)
     return jsonify({"message": "Logged out successfully"})
 
 @app.route('/query', methods=['POST'])
@@ -187,22 +341,35 @@ def handle_query():
         relevant_docs = search_patient_documents(patient_email)
         
         if not relevant_docs:
-            return jsonify({
+            response = jsonify({
                 "query": query,
                 "answer": "I don't have any consent forms on file for you. Please contact your healthcare provider.",
                 "sources": []
             })
+            response.headers['Cache-Control'] = QUERY_CACHE_CONTROL
+            return response
         
         logging.info(f"Found {len(relevant_docs)} documents for patient")
         
-        # Generate answer using AI - restricted to patient's own documents
-        answer = generate_answer(query, relevant_docs)
+        # Repeat questions against unchanged documents reuse the cached answer
+        cache_key = answer_cache_key(patient_email, query, relevant_docs)
+        answer = get_cached_json(cache_key)
+        if answer is None:
+            # Canned questions about a single form are answered from the stored items, skipping Gemini
+            intent = match_canonical_intent(query) if len(relevant_docs) == 1 else None
+            if intent:
+                answer = generate_fallback_answer(intent, relevant_docs)
+            else:
+                # Generate answer using AI - restricted to patient's own documents
+                answer = generate_answer(query, relevant_docs, cache_key=cache_key)
         
-        return jsonify({
+        response = jsonify({
             "query": query,
             "answer": answer,
-            "sources": [doc['filename'] for doc in relevant_docs]
+            "sources": list(dict.fromkeys(doc['filename'] for doc in relevant_docs))  # dedupe, keep order
         })
+        response.headers['Cache-Control'] = QUERY_CACHE_CONTROL
+        return response
         
     except Exception as e:
         logging.error(f"Error processing query: {str(e)}")
@@ -213,33 +380,38 @@ def extract_entities(query):
     # Simple entity extraction - look for patient IDs, names, etc.
     entities = []
     
+    query_lower = query.lower()
+    
     # Look for patient IDs (e.g., "patient 45B", "45B")
-    import re
-    patient_pattern = r'patient\s+(\w+)|\b(\w+)\b'
-    matches = re.findall(patient_pattern, query.lower())
-    for match in matches:
+    for match in PATIENT_PATTERN.findall(query_lower):
         entity = match[0] or match[1]
         if entity and len(entity) > 1:
             entities.append(entity)
     
     # Look for keywords
-    keywords = ['consent', 'decline', 'agree', 'procedure', 'research']
-    for keyword in keywords:
-        if keyword in query.lower():
+    for keyword in QUERY_KEYWORDS:
+        if keyword in query_lower:
             entities.append(keyword)
     
     return entities
 
 def search_patient_documents(patient_email):
     """Search Firestore for documents belonging to specific patient only"""
+    # Consent documents change rarely, so serve repeat queries from Redis
+    cache_key = patient_docs_cache_key(patient_email)
+    cached_docs = get_cached_json(cache_key)
+    if cached_docs is not None:
+        return cached_docs
+    
     docs = []
     
     try:
-        firestore_client = get_firestore_client()
-        
         # Query entity_index for patient-specific documents
-        entity_collection = firestore_client.collection("entity_index")
-        patient_docs = entity_collection.where("patient_email", "==", patient_email).stream()
+        entity_collection = FIRESTORE.collection("entity_index")
+        # Project only the fields the query path uses to cut bytes transferred and decoded
+        patient_docs = entity_collection.where("patient_email", "==", patient_email).select(
+            ["document_id", "summary", "consented_items", "declined_items", "patient_name"]
+        ).stream()
         
         for doc in patient_docs:
             doc_data = doc.to_dict()
@@ -249,32 +421,19 @@ def search_patient_documents(patient_email):
                 'summary': doc_data.get('summary', ''),
                 'consented_items': doc_data.get('consented_items', []),
                 'declined_items': doc_data.get('declined_items', []),
-                'patient_name': doc_data.get('patient_name', 'N/A'),
-                'entities': doc_data.get('entities', {})
+                'patient_name': doc_data.get('patient_name', 'N/A')
             })
         
         logging.info(f"Found {len(docs)} documents for patient {patient_email}")
+        set_cached_json(cache_key, PATIENT_DOCS_CACHE_TTL_SECONDS, docs)
         
     except Exception as e:
         logging.error(f"Error searching patient documents: {str(e)}")
     
     return docs
 
-def generate_answer(query, relevant_docs):
-    """Generate an answer using AI based on relevant documents - patient-specific"""
-    if not relevant_docs:
-        return "No relevant consent forms found for your query."
-    
-    # Prepare context from relevant documents (patient's own documents only)
-    context = ""
-    for doc in relevant_docs[:3]:  # Limit to first 3 docs to save tokens
-        context += f"\nConsent Form: {doc['filename']}\n"
-        context += f"Patient: {doc.get('patient_name', 'N/A')}\n"
-        context += f"Summary: {doc.get('summary', 'N/A')}\n"
-        context += f"Items Consented To: {', '.join(doc.get('consented_items', [])) if doc.get('consented_items') else 'None listed'}\n"
-        context += f"Items Declined: {', '.join(doc.get('declined_items', [])) if doc.get('declined_items') else 'None listed'}\n"
-    
-    prompt = f"""
+# /query answer prompt and per-document context block, filled in with str.format
+ANSWER_PROMPT = """
     You are a helpful medical consent assistant. Based ONLY on the patient's consent form information below, 
     answer their question clearly and concisely in a friendly, professional tone.
     
@@ -292,11 +451,141 @@ def generate_answer(query, relevant_docs):
     Provide a direct, helpful answer based ONLY on the information above. If the information is not available 
     in the provided documents, say so clearly and suggest they contact their healthcare provider.
     """
+CONTEXT_DOC_TEMPLATE = (
+    "\nConsent Form: {filename}\n"
+    "Patient: {patient_name}\n"
+    "Summary: {summary}\n"
+    "Items Consented To: {consented}\n"
+    "Items Declined: {declined}\n"
+)
+
+# Prompt context limits and output settings for /query answers
+MAX_SUMMARY_CHARS = 500
+MAX_CONTEXT_ITEMS = 30
+ANSWER_GENERATION_CONFIG = {"max_output_tokens": 400, "temperature": 0.2}
+
+def answer_cache_key(patient_email, query, relevant_docs):
+    """Redis key for a cached answer; changes whenever the patient's documents change"""
+    normalized_query = ' '.join(query.lower().split())
+    docs_fingerprint = hashlib.md5(
+        json.dumps(sorted(relevant_docs, key=lambda doc: doc['id']), sort_keys=True).encode()
+    ).hexdigest()
+    query_hash = hashlib.md5(normalized_query.encode()).hexdigest()
+    return f"ans:{patient_email}:{docs_fingerprint}:{query_hash}"
+
+# Canonical questions generate_fallback_answer can answer exactly; the intent name doubles as
+# the keyword it matches on. Queries at least CANONICAL_MATCH_THRESHOLD cosine-similar to one
+# of these are answered without calling Gemini, provided they also pass keyword_intent().
+CANONICAL_QUERIES = {
+    'decline': [
+        "What did I decline?",
+        "Which items did I decline?",
+        "Which procedures did I decline?",
+        "Did I decline anything?",
+    ],
+    'consent': [
+        "What did I consent to?",
+        "Which items did I consent to?",
+        "Which items did I agree to?",
+        "What procedures did I agree to?",
+    ],
+}
+# Embeddings barely separate "did I consent" from "did I not consent", so negated queries go to Gemini
+NEGATION_PATTERN = re.compile(r"\b(?:not|never|disagree\w*|refus\w*|withdr[ae]w\w*)\b|n['\u2019]t\b")
+# Whole-word intent keywords, so e.g. "disagree" never counts as "agree"
+DECLINE_KEYWORD_PATTERN = re.compile(r'\bdecline[d]?\b')
+CONSENT_KEYWORD_PATTERN = re.compile(r'\b(?:consent(?:ed)?|agree[d]?)\b')
+CANONICAL_MATCH_THRESHOLD = 0.9
+EMBEDDING_CACHE_TTL_SECONDS = 24 * 60 * 60
+
+def normalize_vector(vector):
+    """Scale a vector to unit length so a dot product is its cosine similarity"""
+    norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+    return [value / norm for value in vector]
+
+def load_canonical_embeddings():
+    """Embed all canonical queries in one call; returns (intent, unit vector) pairs"""
+    pairs = [(intent, text) for intent, texts in CANONICAL_QUERIES.items() for text in texts]
+    try:
+        embeddings = EMBEDDING_MODEL.get_embeddings([text for _, text in pairs])
+    except Exception as e:
+        logging.warning(f"Canonical query embeddings unavailable, FAQ shortcut disabled: {e}")
+        return []
+    return [(intent, normalize_vector(embedding.values)) for (intent, _), embedding in zip(pairs, embeddings)]
+
+CANONICAL_EMBEDDINGS = load_canonical_embeddings() if EMBEDDING_MODEL is not None else []
+
+def embed_query(query):
+    """Unit embedding of a query, cached in Redis by the hash of its normalized text"""
+    normalized_query = ' '.join(query.lower().split())
+    cache_key = f"emb:{hashlib.sha256(normalized_query.encode()).hexdigest()}"
+    vector = get_cached_json(cache_key)
+    if vector is None:
+        vector = normalize_vector(EMBEDDING_MODEL.get_embeddings([normalized_query])[0].values)
+        set_cached_json(cache_key, EMBEDDING_CACHE_TTL_SECONDS, vector)
+    return vector
+
+def keyword_intent(query):
+    """Single intent named by a query's keywords, or None if it is negated, names both or neither"""
+    query_lower = query.lower()
+    if NEGATION_PATTERN.search(query_lower):
+        return None
+    wants_declined = bool(DECLINE_KEYWORD_PATTERN.search(query_lower))
+    wants_consented = bool(CONSENT_KEYWORD_PATTERN.search(query_lower))
+    if wants_declined == wants_consented:
+        # Questions covering both lists (or neither) need the full Gemini answer
+        return None
+    return 'decline' if wants_declined else 'consent'
+
+def match_canonical_intent(query):
+    """Return the canonical intent a query closely matches, or None"""
+    required_intent = keyword_intent(query)
+    if not CANONICAL_EMBEDDINGS or required_intent is None:
+        return None
+    try:
+        query_vector = embed_query(query)
+    except Exception as e:
+        logging.warning(f"Query embedding failed: {e}")
+        return None
+    best_intent, best_score = None, 0.0
+    for intent, vector in CANONICAL_EMBEDDINGS:
+        score = sum(a * b for a, b in zip(query_vector, vector))
+        if score > best_score:
+            best_intent, best_score = intent, score
+    if best_intent != required_intent or best_score < CANONICAL_MATCH_THRESHOLD:
+        return None
+    return best_intent
+
+def generate_answer(query, relevant_docs, cache_key=None):
+    """Generate an answer using AI based on relevant documents - patient-specific"""
+    if not relevant_docs:
+        return "No relevant consent forms found for your query."
+    
+    # Prepare context from relevant documents (patient's own documents only).
+    # Summaries and item lists are capped: Gemini latency and cost grow with input tokens.
+    context_parts = []
+    for doc in relevant_docs[:3]:  # Limit to first 3 docs to save tokens
+        summary = (doc.get('summary') or 'N/A')[:MAX_SUMMARY_CHARS]
+        consented = doc.get('consented_items') or []
+        declined = doc.get('declined_items') or []
+        context_parts.append(CONTEXT_DOC_TEMPLATE.format(
+            filename=doc['filename'],
+            patient_name=doc.get('patient_name', 'N/A'),
+            summary=summary,
+            consented=', '.join(consented[:MAX_CONTEXT_ITEMS]) if consented else 'None listed',
+            declined=', '.join(declined[:MAX_CONTEXT_ITEMS]) if declined else 'None listed'
+        ))
+    context = ''.join(context_parts)
+    
+    prompt = ANSWER_PROMPT.format(query=query, context=context)
     
     try:
-        model = get_model()
-        response = model.generate_content(prompt)
-        return response.text.strip()
+        response = MODEL.generate_content(prompt, generation_config=ANSWER_GENERATION_CONFIG)
+        answer = response.text.strip()
+        # Only AI answers are cached; fallback answers should be retried once the model recovers
+        if cache_key:
+            set_cached_json(cache_key, ANSWER_CACHE_TTL_SECONDS, answer)
+        return answer
     except Exception as e:
         logging.error(f"Error generating AI answer: {str(e)}")
         # Fallback: simple response
@@ -306,27 +595,96 @@ def generate_fallback_answer(query, relevant_docs):
     """Fallback answer generation without AI"""
     query_lower = query.lower()
     
-    for doc in relevant_docs:
+    # Both intents answer from the first document, so no need to loop
+    if relevant_docs:
+        doc = relevant_docs[0]
+        
         if 'decline' in query_lower:
-            declined = doc.get('declined_items', [])
+            declined = doc.get('declined_items') or []
             if declined:
                 return f"Based on your consent form, you declined: {', '.join(declined)}"
-            else:
-                return "Based on your consent form, you didn't decline any items."
+            return "Based on your consent form, you didn't decline any items."
         
         if 'consent' in query_lower or 'agree' in query_lower:
-            consented = doc.get('consented_items', [])
+            consented = doc.get('consented_items') or []
             if consented:
                 return f"Based on your consent form, you consented to: {', '.join(consented)}"
-            else:
-                return "Based on your consent form, no specific consent items were listed."
+            return "Based on your consent form, no specific consent items were listed."
     
     return f"I found your consent form but couldn't extract specific information. Please contact your healthcare provider for details."
 
+# Upload limits (chunk size must be a multiple of 256 KB for GCS resumable uploads)
+MAX_UPLOAD_BYTES = 50 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+UPLOAD_BUCKET_NAME = "consent-management-summarizer-bucket"
+
+# Also enforced by Werkzeug while the body is read, which covers chunked requests without a Content-Length
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
+
+# Uploads to GCS run in the background; files above UPLOAD_SPOOL_BYTES are spooled to disk meanwhile.
+# Cloud Run's disk is in memory, so at most UPLOAD_MAX_PENDING uploads (running + waiting) are held at once.
+UPLOAD_POOL = ThreadPoolExecutor(max_workers=8)
+UPLOAD_MAX_PENDING = 16
+upload_slots = threading.BoundedSemaphore(UPLOAD_MAX_PENDING)
+UPLOAD_SPOOL_BYTES = 5 * 1024 * 1024
+UPLOAD_JOB_PATTERN = re.compile(r'^[0-9a-f-]{36}\.pdf$', re.IGNORECASE)
+
+# Upload job status lives in Redis when configured (visible to every instance), otherwise in-process.
+# A job still queued after UPLOAD_STALE_SECONDS was lost (e.g. instance shut down) and reports failed.
+UPLOAD_JOB_TTL_SECONDS = 24 * 60 * 60
+UPLOAD_STALE_SECONDS = 15 * 60
+local_upload_jobs = TTLCache(maxsize=4096, ttl=UPLOAD_JOB_TTL_SECONDS)
+local_upload_jobs_lock = threading.Lock()
+
+def upload_job_key(job_id):
+    """Redis key holding an upload job's status"""
+    return f"upload:{job_id}"
+
+def save_upload_job(job_id, job):
+    """Record an upload job's status for UPLOAD_JOB_TTL_SECONDS"""
+    if REDIS is not None:
+        set_cached_json(upload_job_key(job_id), UPLOAD_JOB_TTL_SECONDS, job)
+    else:
+        with local_upload_jobs_lock:
+            local_upload_jobs[job_id] = job
+
+def load_upload_job(job_id):
+    """Return an upload job's recorded status, or None if it is unknown"""
+    if REDIS is not None:
+        return get_cached_json(upload_job_key(job_id))
+    with local_upload_jobs_lock:
+        return local_upload_jobs.get(job_id)
+
+def _do_upload(data, unique_filename):
+    """Upload a spooled PDF to Cloud Storage (runs on UPLOAD_POOL)"""
+    try:
+        # Setting chunk_size makes this a resumable upload streamed from the file in fixed-size chunks
+        blob = STORAGE.bucket(UPLOAD_BUCKET_NAME).blob(unique_filename, chunk_size=UPLOAD_CHUNK_SIZE)
+        blob.upload_from_file(data, content_type='application/pdf')
+        save_upload_job(unique_filename, {"status": "uploaded", "updated_at": time.time()})
+        logging.info(f"File uploaded successfully: {unique_filename}")
+    except Exception as e:
+        logging.error(f"Upload error for {unique_filename}: {str(e)}")
+        save_upload_job(unique_filename, {"status": "failed", "error": str(e), "updated_at": time.time()})
+    finally:
+        data.close()
+        upload_slots.release()
+
 @app.route('/upload', methods=['POST'])
 def upload_file():
-    """Handle file uploads to Cloud Storage"""
+    """Accept a PDF upload and queue it for Cloud Storage"""
+    slot_acquired = False
+    queued = False
     try:
+        # Reject oversized uploads before the request body is parsed or anything reaches GCS
+        if request.content_length and request.content_length > MAX_UPLOAD_BYTES:
+            return jsonify({"error": f"File too large (max {MAX_UPLOAD_BYTES // (1024 * 1024)}MB)"}), 413
+        
+        # Shed load before reading the body once the upload backlog is full
+        slot_acquired = upload_slots.acquire(blocking=False)
+        if not slot_acquired:
+            return jsonify({"error": "Too many uploads in progress, please try again shortly"}), 503, {"Retry-After": "10"}
+        
         if 'file' not in request.files:
             return jsonify({"error": "No file provided"}), 400
         
@@ -341,26 +699,60 @@ def upload_file():
         file_extension = os.path.splitext(file.filename)[1]
         unique_filename = f"{uuid.uuid4()}{file_extension}"
         
-        # Upload to Cloud Storage
-        storage_client = get_storage_client()
-        bucket_name = "consent-management-summarizer-bucket"
-        bucket = storage_client.bucket(bucket_name)
-        blob = bucket.blob(unique_filename)
+        # Copy the file out of the request (it is closed once we respond), then upload in the background
+        data = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_BYTES)
+        shutil.copyfileobj(file.stream, data)
+        data.seek(0)
+        save_upload_job(unique_filename, {"status": "queued", "updated_at": time.time()})
+        UPLOAD_POOL.submit(_do_upload, data, unique_filename)
+        queued = True
         
-        # Upload file
-        blob.upload_from_file(file)
-        
-        logging.info(f"File uploaded successfully: {unique_filename}")
+        logging.info(f"File queued for upload: {unique_filename}")
         
         return jsonify({
-            "message": "File uploaded successfully",
+            "message": "File accepted for upload",
+            "job_id": unique_filename,
+            "status": "queued",
             "filename": unique_filename,
             "original_name": file.filename
-        })
+        }), 202
         
+    except RequestEntityTooLarge:
+        return jsonify({"error": f"File too large (max {MAX_UPLOAD_BYTES // (1024 * 1024)}MB)"}), 413
     except Exception as e:
         logging.error(f"Upload error: {str(e)}")
         return jsonify({"error": f"Upload failed: {str(e)}"}), 500
+    finally:
+        # Once queued, _do_upload frees the slot when the background upload ends
+        if slot_acquired and not queued:
+            upload_slots.release()
+
+@app.route('/upload/status/<job_id>', methods=['GET'])
+def upload_status(job_id):
+    """Report whether a queued upload has reached Cloud Storage"""
+    try:
+        if not UPLOAD_JOB_PATTERN.match(job_id):
+            return jsonify({"error": "Invalid job id"}), 400
+        
+        job = load_upload_job(job_id)
+        if job and job["status"] == "failed":
+            return jsonify({"job_id": job_id, "status": "failed", "error": job.get("error")})
+        
+        # The object in GCS is the source of truth for finished uploads
+        if (job and job["status"] == "uploaded") or STORAGE.bucket(UPLOAD_BUCKET_NAME).blob(job_id).exists():
+            return jsonify({"job_id": job_id, "status": "uploaded"})
+        
+        if job is None:
+            return jsonify({"error": "Unknown job id"}), 404
+        
+        if time.time() - job["updated_at"] > UPLOAD_STALE_SECONDS:
+            return jsonify({"job_id": job_id, "status": "failed", "error": "Upload did not complete, please upload the file again"})
+        
+        return jsonify({"job_id": job_id, "status": "queued"})
+        
+    except Exception as e:
+        logging.error(f"Upload status error: {str(e)}")
+        return jsonify({"error": f"Status check failed: {str(e)}"}), 500
 
 @app.route('/ask', methods=['POST'])
 def ask_question():
@@ -373,7 +765,7 @@ def ask_question():
         if not question:
             return jsonify({"error": "No question provided"}), 400
         
-        print(f"Processing question: {question}")
+        logging.info("Processing question: %s", question)
         
         # Step 1: Extract key entity from question
         key_entity = _extract_key_entity(question)
@@ -398,23 +790,16 @@ def ask_question():
         })
         
     except Exception as e:
-        print(f"Error processing question: {str(e)}")
+        logging.error("Error processing question: %s", e)
         return jsonify({"error": f"Internal server error: {str(e)}"}), 500
 
 def _extract_key_entity(question):
     """Extract key entity from question"""
-    import re
-    # Look for patient patterns
-    patient_patterns = [
-        r'patient\s+(\w+)',
-        r'(\w+)\s+declined',
-        r'(\w+)\s+consented',
-        r'what\s+did\s+(\w+)',
-        r'(\w+)\s+patient'
-    ]
+    question_lower = question.lower()
     
-    for pattern in patient_patterns:
-        match = re.search(pattern, question.lower())
+    # Look for patient patterns
+    for pattern in KEY_ENTITY_PATTERNS:
+        match = pattern.search(question_lower)
         if match:
             return match.group(1)
     
@@ -423,43 +808,30 @@ def _extract_key_entity(question):
 def _resolve_document_from_entity(entity):
     """Use Firestore to find document data for entity"""
     try:
-        firestore_client = get_firestore_client()
-        
         # Search in entity_index collection
-        entity_collection = firestore_client.collection("entity_index")
+        entity_collection = FIRESTORE.collection("entity_index")
         
-        # Try exact match on patient_name
-        docs = entity_collection.where("patient_name", "==", entity).stream()
-        for doc in docs:
-            return doc.to_dict()
-        
-        # Try partial match on search_terms
-        docs = entity_collection.where("search_terms", "array_contains", entity.lower()).stream()
-        for doc in docs:
-            return doc.to_dict()
-        
-        # Try partial match on patient_name
-        docs = entity_collection.where("patient_name", ">=", entity).where("patient_name", "<=", entity + "\uf8ff").stream()
+        # search_terms holds lowercased entity values and patient name tokens, so a single
+        # array_contains lookup covers full-name, name-token and other entity matches
+        docs = entity_collection.where("search_terms", "array_contains", entity.lower()).limit(1).stream()
         for doc in docs:
             return doc.to_dict()
             
     except Exception as e:
-        print(f"Firestore entity resolution error: {e}")
+        logging.error("Firestore entity resolution error: %s", e)
     return None
 
 def _get_most_recent_document():
     """Get the most recently processed document"""
     try:
-        firestore_client = get_firestore_client()
-        
         # Get all documents from entity_index collection and return the first one
-        docs = firestore_client.collection("entity_index").limit(1).stream()
+        docs = FIRESTORE.collection("entity_index").limit(1).stream()
         
         for doc in docs:
             return doc.to_dict()
             
     except Exception as e:
-        print(f"Error getting most recent document: {e}")
+        logging.error("Error getting most recent document: %s", e)
     return None
 
 def _generate_contextual_answer(question, document_data):
@@ -487,7 +859,7 @@ def _generate_contextual_answer(question, document_data):
         return f"Based on {document_id}: {summary_text}"
         
     except Exception as e:
-        print(f"Answer generation error: {e}")
+        logging.error("Answer generation error: %s", e)
         return f"Found document but couldn't generate specific answer."
 
 @app.route('/health', methods=['GET'])